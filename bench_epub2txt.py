@@ -0,0 +1,212 @@
+"""
+benchmark of the xml layer of epub2txt on epubs with large tables of contents
+
+a fixture set of anthology-like epubs (nested NCX and EPUB3 nav, thousands of
+entries) is generated into --fixtures unless it already exists there.
+for every epub, the table of contents is parsed with EpubXmlParser and, for
+the NCX, with the string-concatenating parser it replaced ("legacy"), and
+read_toc is timed as a whole (container, OPF and table of contents).
+the fixtures run from the smallest to the largest, and every timing is the
+median of --repeat runs.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import xml.parsers.expat
+import zipfile
+from glob import glob
+
+import epub2txt
+
+SIZES = (1000, 5000, 20000)
+
+
+def make_fixture(path, n_entries, kind):
+    """an epub whose toc has n_entries entries, two levels deep"""
+    items = "".join(
+        f'<item id="c{i}" href="text/c{i}.xhtml" '
+        'media-type="application/xhtml+xml"/>'
+        for i in range(n_entries // 10)
+    )
+    spine = "".join(f'<itemref idref="c{i}"/>' for i in range(n_entries // 10))
+    label = "Story &amp; Part {} &#8212; a rather long entry title, line {}"
+    if kind == "ncx":
+        items += (
+            '<item id="ncx" href="toc.ncx" '
+            'media-type="application/x-dtbncx+xml"/>'
+        )
+        entries = []
+        for i in range(0, n_entries, 10):
+            entries.append(
+                f'<navPoint id="n{i}" playOrder="{i}"><navLabel><text>'
+                f"{label.format(i, i)}</text></navLabel>"
+                f'<content src="text/c{i // 10}.xhtml"/>'
+            )
+            for j in range(i + 1, i + 10):
+                entries.append(
+                    f'<navPoint id="n{j}" playOrder="{j}"><navLabel><text>'
+                    f"{label.format(j, j)}</text></navLabel>"
+                    f'<content src="text/c{i // 10}.xhtml#s{j}"/></navPoint>'
+                )
+            entries.append("</navPoint>\n")
+        toc_name = "toc.ncx"
+        toc = (
+            '<?xml version="1.0"?><ncx><navMap>'
+            f'{"".join(entries)}</navMap></ncx>'
+        )
+    else:
+        items += (
+            '<item id="nav" href="nav.xhtml" '
+            'media-type="application/xhtml+xml" properties="nav"/>'
+        )
+        entries = []
+        for i in range(0, n_entries, 10):
+            entries.append(
+                f'<li><a href="text/c{i // 10}.xhtml">'
+                f"{label.format(i, i)}</a><ol>"
+            )
+            for j in range(i + 1, i + 10):
+                entries.append(
+                    f'<li><a href="text/c{i // 10}.xhtml#s{j}">'
+                    f"{label.format(j, j)}</a></li>"
+                )
+            entries.append("</ol></li>\n")
+        toc_name = "nav.xhtml"
+        toc = (
+            '<?xml version="1.0"?>'
+            '<html xmlns:epub="http://www.idpf.org/2007/ops">'
+            f'<body><nav epub:type="toc"><ol>{"".join(entries)}</ol></nav>'
+            "</body></html>"
+        )
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(
+            "META-INF/container.xml",
+            '<?xml version="1.0"?><container><rootfiles>'
+            '<rootfile full-path="OEBPS/content.opf"/>'
+            "</rootfiles></container>",
+        )
+        z.writestr(
+            "OEBPS/content.opf",
+            '<?xml version="1.0"?><package '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/"><metadata>'
+            "<dc:title>Anthology</dc:title><dc:creator>Many</dc:creator>"
+            "<dc:language>en</dc:language></metadata>"
+            f"<manifest>{items}</manifest><spine>{spine}</spine></package>",
+        )
+        z.writestr("OEBPS/" + toc_name, toc)
+
+
+def make_fixtures(fixture_dir):
+    os.makedirs(fixture_dir, exist_ok=True)
+    for n_entries in SIZES:
+        for kind in ("ncx", "nav"):
+            path = os.path.join(fixture_dir, f"toc_{kind}_{n_entries}.epub")
+            if not os.path.exists(path):
+                make_fixture(path, n_entries, kind)
+
+
+class LegacyTocParser:
+    """the NCX parser before EpubXmlParser, accumulating with +="""
+
+    def __init__(self, xmlcontent):
+        self.xml = xmlcontent
+        self.stack = []
+        self.inText = 0
+        self.toc = []
+
+    def startElement(self, name, attributes):
+        if name == "navPoint":
+            self.currentNP = epub2txt.NavPoint(
+                attributes["id"], attributes["playOrder"], len(self.stack)
+            )
+            self.stack.append(self.currentNP)
+            self.toc.append(self.currentNP)
+        elif name == "content":
+            self.currentNP.content = epub2txt.unquote(attributes["src"])
+        elif name == "text":
+            self.buffer = ""
+            self.inText = 1
+
+    def characters(self, data):
+        if self.inText:
+            self.buffer += data
+
+    def endElement(self, name):
+        if name == "navPoint":
+            self.currentNP = self.stack.pop()
+        elif name == "text":
+            self.currentNP.text = self.buffer
+            self.inText = 0
+
+    def parseToc(self):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characters
+        parser.Parse(self.xml, 1)
+        return self.toc
+
+
+def bench(fn, repeat):
+    """median time of repeat runs of fn, and its result"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--fixtures",
+        type=str,
+        default=os.path.join(tempfile.gettempdir(), "epub2txt_bench"),
+    )
+    parser.add_argument("--repeat", type=int, default=25)
+    args = parser.parse_args()
+
+    make_fixtures(args.fixtures)
+
+    print(
+        f"{'fixture':<24}{'entries':>8}{'toc':>10}{'legacy':>10}"
+        f"{'read_toc':>10}"
+    )
+    fixtures = []
+    for path in glob(os.path.join(args.fixtures, "toc_*_*.epub")):
+        _, kind, n_entries = os.path.basename(path)[:-5].split("_")
+        fixtures.append((int(n_entries), kind, path))
+    for _, kind, path in sorted(fixtures):
+        with zipfile.ZipFile(path, "r") as file:
+            toc_xml = file.read(
+                "OEBPS/toc.ncx" if kind == "ncx" else "OEBPS/nav.xhtml"
+            )
+            xml_parser = epub2txt.EpubXmlParser()
+            seconds, toc = bench(
+                lambda: xml_parser.parseToc(toc_xml, kind), args.repeat
+            )
+            legacy = ""
+            if kind == "ncx":
+                legacy_seconds, _ = bench(
+                    lambda: LegacyTocParser(toc_xml).parseToc(), args.repeat
+                )
+                legacy = f"{legacy_seconds * 1000:.1f}ms"
+            book = epub2txt.epub2txt(path)
+            read_seconds, _ = bench(
+                lambda: book.read_toc(file, epub2txt.EpubXmlParser()),
+                args.repeat,
+            )
+        print(
+            f"{os.path.basename(path):<24}{len(toc):>8}"
+            f"{seconds * 1000:>8.1f}ms{legacy:>10}"
+            f"{read_seconds * 1000:>8.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
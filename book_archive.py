@@ -0,0 +1,189 @@
+"""
+packed book archive, instead of one small txt per book
+
+an archive is a directory with
+    data-<tag>.bin      append-only concatenation of records
+    index-<tag>.jsonl   one line per committed record:
+                        {"key", "data", "offset", "length", "codec"}
+every writer appends to its own pair of files, so concurrent downloaders
+never contend for a lock. a record becomes visible only once its index
+line is written, and the index is written after the data is fsynced,
+so a killed writer leaves at most some unreferenced bytes behind.
+readers merge all the indexes (the last commit of a key wins) and read
+the data files with mmap.
+
+the keys are the txt file names used by download_files, so the done list
+and the selection manifest work the same for txts and archives.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import socket
+import sys
+import uuid
+import zlib
+from glob import glob
+
+
+class BookArchiveWriter:
+    def __init__(self, path, compress=True, level=6):
+        self.path = path
+        self.codec = "zlib" if compress else "raw"
+        self.level = level
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+
+        tag = "{}-{}-{}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+        )
+        self.data_name = "data-{}.bin".format(tag)
+        self.data_file = open(os.path.join(path, self.data_name), "ab")
+        self.index_file = open(
+            os.path.join(path, "index-{}.jsonl".format(tag)),
+            "a",
+            encoding="utf8",
+        )
+        self.offset = self.data_file.tell()
+        self.pending = []
+
+    def add(self, key, txt):
+        """append a book, it is visible to readers after commit()"""
+        blob = txt.encode("utf8")
+        if self.codec == "zlib":
+            blob = zlib.compress(blob, self.level)
+        self.data_file.write(blob)
+        self.pending.append(
+            {
+                "key": key,
+                "data": self.data_name,
+                "offset": self.offset,
+                "length": len(blob),
+                "codec": self.codec,
+            }
+        )
+        self.offset += len(blob)
+
+    def commit(self):
+        if not self.pending:
+            return
+        self.data_file.flush()
+        os.fsync(self.data_file.fileno())
+        for entry in self.pending:
+            print(json.dumps(entry), file=self.index_file)
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.pending = []
+
+    def close(self):
+        self.commit()
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # drop the records of a failed batch, they are never indexed
+            self.pending = []
+        self.close()
+
+
+class BookArchive:
+    """read-only view of the records committed when it was opened"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.maps = {}
+
+        sizes = {}
+        index_paths = sorted(glob(os.path.join(path, "index-*.jsonl")))
+        for index_path in index_paths:
+            with open(index_path, "r", encoding="utf8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn line of a writer that was killed
+                        continue
+                    data_name = entry["data"]
+                    if data_name not in sizes:
+                        sizes[data_name] = os.path.getsize(
+                            os.path.join(path, data_name)
+                        )
+                    if entry["offset"] + entry["length"] > sizes[data_name]:
+                        continue
+                    self.index[entry["key"]] = entry
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return list(sorted(self.index))
+
+    def _map(self, data_name):
+        if data_name not in self.maps:
+            with open(os.path.join(self.path, data_name), "rb") as f:
+                self.maps[data_name] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return self.maps[data_name]
+
+    def read(self, key):
+        entry = self.index[key]
+        if entry["length"] == 0:
+            # an empty raw record, its data file may be empty too,
+            # and an empty file cannot be mapped
+            return ""
+        mm = self._map(entry["data"])
+        blob = mm[entry["offset"] : entry["offset"] + entry["length"]]
+        if entry["codec"] == "zlib":
+            blob = zlib.decompress(blob)
+        return blob.decode("utf8")
+
+    def close(self):
+        for mm in self.maps.values():
+            mm.close()
+        self.maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def pack(txt_dir, path, compress=True):
+    """pack an existing directory of txts into an archive"""
+    done = BookArchive(path) if os.path.exists(path) else {}
+    n_pack = 0
+    with BookArchiveWriter(path, compress=compress) as writer:
+        for txt_path in sorted(glob(os.path.join(txt_dir, "*.txt"))):
+            key = os.path.basename(txt_path)
+            if key in done:
+                continue
+            with open(txt_path, "r", encoding="utf8") as f:
+                writer.add(key, f.read())
+            n_pack += 1
+            if n_pack % 1000 == 0:
+                writer.commit()
+    return n_pack
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("txt_dir", type=str)
+    parser.add_argument("archive", type=str)
+    parser.add_argument("--no-compress", action="store_true")
+    args = parser.parse_args()
+
+    n_pack = pack(args.txt_dir, args.archive, not args.no_compress)
+    sys.stderr.write(
+        "{} txts packed into {}.\n".format(n_pack, args.archive)
+    )
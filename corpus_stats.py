@@ -0,0 +1,86 @@
+"""
+mergeable statistics of the sharded corpus
+
+make_shards workers fill a CorpusStats per book with the sentences they
+already tokenize, and the parent merges them, so token frequencies,
+length histograms and per-book yield come without another pass over
+the shards. the merged token counts also give the vocabulary.
+"""
+
+import json
+from collections import Counter
+
+import numpy as np
+
+MAX_TOKENS = 128
+MAX_CHARS = 8192
+CHAR_BIN = 64
+
+
+class CorpusStats:
+    def __init__(self):
+        self.tokens = Counter()
+        # number of kept sentences by number of tokens
+        self.token_lengths = np.zeros(MAX_TOKENS + 1, dtype=np.int64)
+        # number of kept sentences by number of characters, CHAR_BIN wide
+        self.char_lengths = np.zeros(
+            MAX_CHARS // CHAR_BIN + 1, dtype=np.int64
+        )
+        # book -> {"kept": n, "dropped": {reason: n}}
+        self.books = {}
+
+    def _book(self, book):
+        if book not in self.books:
+            self.books[book] = {"kept": 0, "dropped": {}}
+        return self.books[book]
+
+    def keep(self, book, tokens, sent):
+        self.tokens.update(tokens)
+        self.token_lengths[min(len(tokens), MAX_TOKENS)] += 1
+        self.char_lengths[min(len(sent), MAX_CHARS) // CHAR_BIN] += 1
+        self._book(book)["kept"] += 1
+
+    def drop(self, book, reason):
+        dropped = self._book(book)["dropped"]
+        dropped[reason] = dropped.get(reason, 0) + 1
+
+    def merge(self, other):
+        self.tokens.update(other.tokens)
+        self.token_lengths += other.token_lengths
+        self.char_lengths += other.char_lengths
+        for book, counts in other.books.items():
+            mine = self._book(book)
+            mine["kept"] += counts["kept"]
+            for reason, n in counts["dropped"].items():
+                mine["dropped"][reason] = mine["dropped"].get(reason, 0) + n
+        return self
+
+    def to_dict(self):
+        dropped = Counter()
+        for counts in self.books.values():
+            dropped.update(counts["dropped"])
+        return {
+            "n_books": len(self.books),
+            "n_sents": int(self.token_lengths.sum()),
+            "n_tokens": sum(self.tokens.values()),
+            "n_types": len(self.tokens),
+            "dropped": dict(dropped),
+            "token_length_hist": self.token_lengths.tolist(),
+            "char_length_bin": CHAR_BIN,
+            "char_length_hist": self.char_lengths.tolist(),
+            "books": dict(sorted(self.books.items())),
+        }
+
+    def write(self, stats_path):
+        with open(stats_path, "w", encoding="utf8") as f:
+            json.dump(self.to_dict(), f)
+
+    def write_vocab(self, vocab_path, min_count=1):
+        """token<TAB>count per line, most frequent first"""
+        with open(vocab_path, "w", encoding="utf8") as f:
+            for token, count in sorted(
+                self.tokens.items(), key=lambda x: (-x[1], x[0])
+            ):
+                if count < min_count:
+                    break
+                print(f"{token}\t{count}", file=f)
@@ -4,15 +4,19 @@ epub are converted to markdown
 """
 
 import argparse
+import contextlib
 import json
 import os
+import re
 import sys
 from glob import glob
 
 import requests
 import tqdm
 
+import book_archive
 import epub2txt
+import filter_rules
 
 cj = requests.cookies.RequestsCookieJar()
 
@@ -26,25 +30,114 @@ parser.add_argument("--trash-bad-count", action="store_true", default=True)
 parser.add_argument(
     "--languages", "--langs", "--lang", nargs="+", type=str, default=["English"]
 )
+parser.add_argument(
+    "--archive",
+    type=str,
+    default=None,
+    help="write books into a packed archive instead of one txt per book",
+)
+parser.add_argument("--no-compress", action="store_true")
+parser.add_argument(
+    "--word-count-log",
+    type=str,
+    default=None,
+    help="jsonl of the word count checks, <out-dir>/word_counts.jsonl",
+)
 args = parser.parse_args()
 
-SKIPS = ["Plays", "Screenplays"]
+word_pt = re.compile(r"\S+")
 
 
-def write_txt(txt, out_path, num_words=None):
+class WordCountError(Exception):
+    def __init__(self, counted_num_words, num_words):
+        super().__init__(
+            "too many words: {} counted so far for {} expected".format(
+                counted_num_words, num_words
+            )
+        )
+        self.counted_num_words = counted_num_words
+
+
+def count_words(text):
+    # same count as len(text.split()) without building the list of words
+    return sum(1 for _ in word_pt.finditer(text))
+
+
+def stream_txt(chunks, num_words, max_ratio=1.5):
+    """
+    join the chapters streamed out of the converter, counting words on the fly
+    stops converting as soon as the count goes past max_ratio * num_words
+    """
+    content = []
+    counted_num_words = 0
+    for chunk in chunks:
+        counted_num_words += count_words(chunk)
+        if counted_num_words >= num_words * max_ratio:
+            raise WordCountError(counted_num_words, num_words)
+        content.append(chunk)
+    return "".join(content), counted_num_words
+
+
+def write_txt(
+    txt, out_path, num_words=None, archive=None, counted_num_words=None
+):
     # occasionally, some epubs text are decoded with errors
     # e.g. repeated bib lines
     # filter out them by comparing number of words
-    counted_num_words = len(txt.split())
     if not txt.strip():
-        pass
-    elif num_words is None or (
-        num_words * 0.5 < counted_num_words < num_words * 1.5
-    ):
-        with open(
-            out_path, "w", encoding="utf8"
-        ) as txt_out:  # convert epub2txt and save
-            txt_out.write(txt)
+        return "empty"
+    if num_words is not None:
+        if counted_num_words is None:
+            counted_num_words = count_words(txt)
+        if not num_words * 0.5 < counted_num_words < num_words * 1.5:
+            return "bad_count"
+    if archive is not None:
+        archive.add(os.path.basename(out_path), txt)
+        archive.commit()
+        return "saved"
+    with open(
+        out_path, "w", encoding="utf8"
+    ) as txt_out:  # convert epub2txt and save
+        txt_out.write(txt)
+    return "saved"
+
+
+def write_epub(book, out_path, num_words, archive=None):
+    """
+    convert and save an epub whose word count is checked against num_words
+    books that inspection finds broken are skipped before any conversion runs,
+    the warnings and the estimated word count are only logged
+    returns the record for the word count log
+    """
+    info = book.inspect(num_words)
+    record = {
+        "file": os.path.basename(out_path),
+        "language": info["language"],
+        "num_words": num_words,
+        "estimated_num_words": info["estimated_num_words"],
+        "counted_num_words": None,
+        "ratio": None,
+        "warnings": info["warnings"],
+    }
+    if info["problems"]:
+        record["status"] = "inspect:" + ",".join(info["problems"])
+        return record
+
+    try:
+        # closing the generator closes the epub before it is removed,
+        # also when the conversion is aborted halfway
+        with contextlib.closing(book.iter_chapters()) as chapters:
+            txt, counted_num_words = stream_txt(chapters, num_words)
+        status = write_txt(
+            txt, out_path, num_words, archive, counted_num_words
+        )
+    except WordCountError as e:
+        counted_num_words = e.counted_num_words
+        status = "aborted"
+    record["counted_num_words"] = counted_num_words
+    record["ratio"] = counted_num_words / num_words if num_words else None
+    record["status"] = status
+    return record
 
 
 def main():
@@ -55,19 +148,32 @@ def main():
     filelist_path = args.list_path
 
     lines = list(open(filelist_path).readlines())
+    rule = filter_rules.compile_rules(args.languages)
 
-    done_files = set(
-        [
-            os.path.split(path)[-1]
-            for path in glob(os.path.join(out_dir, "*.txt"))
-        ]
-    )
+    if args.archive:
+        done_files = set(book_archive.BookArchive(args.archive).keys())
+        archive = book_archive.BookArchiveWriter(
+            args.archive, compress=not args.no_compress
+        )
+    else:
+        done_files = set(
+            [
+                os.path.split(path)[-1]
+                for path in glob(os.path.join(out_dir, "*.txt"))
+            ]
+        )
+        archive = None
     sys.stderr.write(
         "{} files already had been saved in {}.\n".format(
-            len(done_files), out_dir
+            len(done_files), args.archive or out_dir
         )
     )
 
+    word_count_log = args.word_count_log or os.path.join(
+        out_dir, "word_counts.jsonl"
+    )
+    f_log = open(word_count_log, "a", encoding="utf8")
+
     for i, line in enumerate(tqdm.tqdm(lines, ascii=True)):
         if not line.strip():
             continue
@@ -76,34 +182,11 @@ def main():
             # {"page": "https://www.smashwords.com/books/view/52", "epub": "https://www.smashwords.com/books/download/52/8/latest/0/0/smashwords-style-guide.epub", "title": "Smashwords Style Guide", "author": "Mark Coker", "genres": ["Nonfiction\tComputers and Internet\tDigital publishing", "Nonfiction\tPublishing\tSelf-publishing"], "publish": "May 05, 2008", "num_words": 28300, "b_idx": 1}
             data = json.loads(line.strip())
 
-            if "lang" not in data:
-                raise Exception(
-                    "Language filter is available "
-                    "when the url list has lang information. "
-                    "Please regenerate url list with the latest script."
-                )
-            if data["lang"] not in args.languages:
-                continue
-
-            skip = False
-
-            for skip_genre in SKIPS:
-                for genre in data["genres"]:
-                    if skip_genre in genre:
-                        skip = True
-                        break
-                if skip:
-                    break
-
-            if skip:
+            if rule(data) is not None:
                 continue
 
-            _, book_id = os.path.split(data["page"])
             _, file_name = os.path.split(data["epub"])
-
-            out_file_name = "{}__{}".format(
-                book_id, file_name.replace(".epub", ".txt")
-            )
+            out_file_name = filter_rules.out_file_name(data)
             out_path = os.path.join(out_dir, out_file_name)
             if out_file_name in done_files:
                 continue
@@ -111,7 +194,7 @@ def main():
                 # try to download .txt file
                 r = requests.get(data["txt"], cookies=cj)
                 txt = r.text
-                write_txt(txt, out_path, None)
+                write_txt(txt, out_path, None, archive)
             else:
                 # revenge by converting .epub to .txt
                 tmp_path = os.path.join(out_dir, file_name)
@@ -119,12 +202,15 @@ def main():
                 with open(tmp_path, "wb") as tmp_f:
                     tmp_f.write(r.content)
 
-                txt = epub2txt.epub2txt(tmp_path).convert()
+                book = epub2txt.epub2txt(tmp_path)
                 if args.trash_bad_count:
                     if "num_words" in data:
-                        write_txt(txt, out_path, data["num_words"])
+                        record = write_epub(
+                            book, out_path, data["num_words"], archive
+                        )
+                        print(json.dumps(record), file=f_log, flush=True)
                 else:
-                    write_txt(txt, out_path, None)
+                    write_txt(book.convert(), out_path, None, archive)
         except Exception as e:
             sys.stderr.write(str(e) + "\n")
             if os.path.exists(out_path):
@@ -135,6 +221,10 @@ def main():
         except:
             pass
 
+    f_log.close()
+    if archive is not None:
+        archive.close()
+
 
 if __name__ == "__main__":
     main()
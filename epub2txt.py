@@ -2,9 +2,15 @@
 convert epub to txt (markdown)
 """
 
+import argparse
+import hashlib
+import json
 import os
+import posixpath
 import sys
+import traceback
 import urllib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 try:
     from urllib import unquote
@@ -13,161 +19,559 @@ except:
 import zipfile
 
 import xml.parsers.expat
+from html.entities import name2codepoint
 import html2text
 from glob import glob
 
 
-class ContainerParser:
-    def __init__(self, xmlcontent=None):
-        self.rootfile = ""
-        self.xml = xmlcontent
+# uncompressed bytes of xhtml per word, to estimate the number of words
+# a rough guess, not calibrated on real books: do not filter on it
+BYTES_PER_WORD = 8
 
-    def startElement(self, name, attributes):
-        if name == "rootfile":
-            self.buffer = ""
-            self.rootfile = attributes["full-path"]
 
-    def parseContainer(self):
-        parser = xml.parsers.expat.ParserCreate()
-        parser.StartElementHandler = self.startElement
-        parser.Parse(self.xml, 1)
-        return self.rootfile
+class NavPoint:
+    __slots__ = ("id", "playorder", "level", "content", "text")
+
+    def __init__(
+        self, id=None, playorder=None, level=0, content=None, text=None
+    ):
+        self.id = id
+        self.content = content
+        self.playorder = playorder
+        self.level = level
+        self.text = text
+
+
+NCX_MEDIA_TYPE = "application/x-dtbncx+xml"
+# ids of the NCX in epubs without a media-type for it
+NCX_IDS = ("ncx", "toc", "ncxtoc")
+DC_FIELDS = {
+    "dc:title": "title",
+    "dc:creator": "author",
+    "dc:language": "language",
+}
+
+
+def local_name(name):
+    return name[name.find(":") + 1 :]
+
 
+class EpubXmlParser:
+    """
+    one streaming handler for the xml of an epub: container.xml, the OPF,
+    and the table of contents as an NCX or an EPUB3 nav document
 
-class BookParser:
-    def __init__(self, xmlcontent=None):
-        self.xml = xmlcontent
+    text is collected in a list and joined once per element, and the same
+    instance serves every document of a book. expat parsers cannot be
+    reset, so only the expat object itself is created per document.
+    the local names of the elements are cached by their qualified name,
+    so that the handlers compare exact names instead of slicing every one.
+    """
+
+    def __init__(self):
+        self.handlers = {
+            "container": (self.containerStart, None),
+            "opf": (self.opfStart, self.opfEnd),
+            "ncx": (self.ncxStart, self.ncxEnd),
+            "nav": (self.navStart, self.navEnd),
+        }
+        self.localNames = {}
+        self.rootfile = ""
+        self.resetBook()
+        self.resetToc()
+
+    def resetBook(self):
         self.title = ""
         self.author = ""
-        self.inTitle = 0
-        self.inAuthor = 0
+        self.language = ""
+        # manifest id -> href, and the spine as a list of manifest ids
+        self.items = {}
+        self.spine = []
+        self.spineToc = ""
         self.ncx = ""
+        self.nav = ""
+        self.field = None
+        self.buffer = None
 
-    def startElement(self, name, attributes):
-        if name == "dc:title":
-            self.buffer = ""
-            self.inTitle = 1
-        elif name == "dc:creator":
-            self.buffer = ""
-            self.inAuthor = 1
-        elif name == "item":
-            if (
-                attributes["id"] == "ncx"
-                or attributes["id"] == "toc"
-                or attributes["id"] == "ncxtoc"
-            ):
-                self.ncx = attributes["href"]
+    def resetToc(self):
+        self.toc = []
+        self.stack = []
+        self.currentNP = None
+        self.inNav = 0
+        self.depth = 0
+        self.buffer = None
 
-    def characters(self, data):
-        if self.inTitle:
-            self.buffer += data
-        elif self.inAuthor:
-            self.buffer += data
-
-    def endElement(self, name):
-        if name == "dc:title":
-            self.inTitle = 0
-            self.title = self.buffer
-            self.buffer = ""
-        elif name == "dc:creator":
-            self.inAuthor = 0
-            self.author = self.buffer
-            self.buffer = ""
-
-    def parseBook(self):
+    def parse(self, xmlcontent, kind):
+        start, end = self.handlers[kind]
         parser = xml.parsers.expat.ParserCreate()
-        parser.StartElementHandler = self.startElement
-        parser.EndElementHandler = self.endElement
+        parser.buffer_text = True
+        if kind == "nav":
+            # xhtml entities such as &nbsp; are not errors
+            parser.UseForeignDTD(True)
+            parser.SkippedEntityHandler = self.skippedEntity
+        parser.StartElementHandler = start
+        if end is not None:
+            parser.EndElementHandler = end
         parser.CharacterDataHandler = self.characters
-        parser.Parse(self.xml, 1)
-        return self.title, self.author, self.ncx
+        parser.Parse(xmlcontent, 1)
 
+    def localName(self, name):
+        local = self.localNames[name] = local_name(name)
+        return local
 
-class NavPoint:
-    def __init__(
-        self, id=None, playorder=None, level=0, content=None, text=None
-    ):
-        self.id = id
-        self.content = content
-        self.playorder = playorder
-        self.level = level
-        self.text = text
+    def characters(self, data):
+        if self.buffer is not None:
+            self.buffer.append(data)
 
+    def skippedEntity(self, name, is_parameter_entity):
+        if self.buffer is not None and name in name2codepoint:
+            self.buffer.append(chr(name2codepoint[name]))
 
-class TocParser:
-    def __init__(self, xmlcontent=None):
-        self.xml = xmlcontent
-        self.currentNP = None
-        self.stack = []
-        self.inText = 0
-        self.toc = []
+    def containerStart(self, name, attributes):
+        name = self.localNames.get(name) or self.localName(name)
+        if name == "rootfile" and not self.rootfile:
+            self.rootfile = attributes.get("full-path", "")
 
-    def startElement(self, name, attributes):
+    def opfStart(self, name, attributes):
+        if name in DC_FIELDS:
+            self.field = DC_FIELDS[name]
+            self.buffer = []
+            return
+        name = self.localNames.get(name) or self.localName(name)
+        if name == "item":
+            item_id = attributes.get("id", "")
+            href = attributes.get("href", "")
+            media_type = attributes.get("media-type", "")
+            self.items[item_id] = href
+            if media_type == NCX_MEDIA_TYPE:
+                self.ncx = href
+            elif item_id in NCX_IDS and not self.ncx and not media_type:
+                self.ncx = href
+            if "nav" in attributes.get("properties", "").split():
+                self.nav = href
+        elif name == "itemref":
+            self.spine.append(attributes.get("idref", ""))
+        elif name == "spine":
+            self.spineToc = attributes.get("toc", "")
+
+    def opfEnd(self, name):
+        if self.field is not None and DC_FIELDS.get(name) == self.field:
+            setattr(self, self.field, "".join(self.buffer).strip())
+            self.field = None
+            self.buffer = None
+
+    def ncxStart(self, name, attributes):
+        name = self.localNames.get(name) or self.localName(name)
         if name == "navPoint":
             level = len(self.stack)
             self.currentNP = NavPoint(
-                attributes["id"], attributes["playOrder"], level
+                attributes.get("id"), attributes.get("playOrder"), level
             )
             self.stack.append(self.currentNP)
             self.toc.append(self.currentNP)
         elif name == "content":
-            self.currentNP.content = unquote(attributes["src"])
+            if self.currentNP is not None:
+                self.currentNP.content = unquote(attributes.get("src", ""))
         elif name == "text":
-            self.buffer = ""
-            self.inText = 1
-
-    def characters(self, data):
-        if self.inText:
-            self.buffer += data
+            self.buffer = []
 
-    def endElement(self, name):
+    def ncxEnd(self, name):
+        name = self.localNames.get(name) or self.localName(name)
         if name == "navPoint":
-            self.currentNP = self.stack.pop()
+            self.stack.pop()
+            self.currentNP = self.stack[-1] if self.stack else None
         elif name == "text":
-            if self.inText and self.currentNP:
-                self.currentNP.text = self.buffer
-            self.inText = 0
+            if self.buffer is not None and self.currentNP is not None:
+                self.currentNP.text = "".join(self.buffer)
+            self.buffer = None
 
-    def parseToc(self):
-        parser = xml.parsers.expat.ParserCreate()
-        parser.StartElementHandler = self.startElement
-        parser.EndElementHandler = self.endElement
-        parser.CharacterDataHandler = self.characters
-        parser.Parse(self.xml, 1)
+    def navStart(self, name, attributes):
+        name = self.localNames.get(name) or self.localName(name)
+        if name == "nav":
+            self.inNav = "toc" in attributes.get("epub:type", "").split()
+        elif not self.inNav:
+            return
+        elif name == "ol":
+            self.depth += 1
+        elif name == "a" and attributes.get("href"):
+            self.currentNP = NavPoint(
+                None,
+                str(len(self.toc) + 1),
+                max(self.depth - 1, 0),
+                unquote(attributes["href"]),
+            )
+            self.toc.append(self.currentNP)
+            self.buffer = []
+
+    def navEnd(self, name):
+        name = self.localNames.get(name) or self.localName(name)
+        if name == "nav":
+            self.inNav = 0
+        elif not self.inNav:
+            return
+        elif name == "ol":
+            self.depth -= 1
+        elif name == "a" and self.currentNP is not None:
+            self.currentNP.text = " ".join("".join(self.buffer).split())
+            self.currentNP = None
+            self.buffer = None
+
+    def parseContainer(self, xmlcontent):
+        self.rootfile = ""
+        self.parse(xmlcontent, "container")
+        return self.rootfile
+
+    def parseBook(self, xmlcontent):
+        self.resetBook()
+        self.parse(xmlcontent, "opf")
+        return self.title, self.author, self.tocDocument()
+
+    def parseToc(self, xmlcontent, kind="ncx"):
+        self.resetToc()
+        self.parse(xmlcontent, kind)
         return self.toc
 
+    def tocDocument(self):
+        """href and kind of the table of contents, ("", "") without one"""
+        if self.spineToc in self.items:
+            return self.items[self.spineToc], "ncx"
+        if self.ncx:
+            return self.ncx, "ncx"
+        if self.nav:
+            return self.nav, "nav"
+        return "", ""
+
+    def spineAsToc(self):
+        """a flat table of contents from the spine, for books without one"""
+        return [
+            NavPoint(idref, str(i + 1), 0, unquote(self.items[idref]), "")
+            for i, idref in enumerate(self.spine)
+            if idref in self.items
+        ]
+
 
 class epub2txt:
     def __init__(self, epubfile=None):
         self.epub = epubfile
 
-    def convert(self):
+    def read_toc(self, file, parser):
+        """
+        the table of contents of an opened epub, the NCX, else the EPUB3 nav,
+        else the spine, with the content of each entry resolved in the zip
+        """
+        rootfile = parser.parseContainer(file.read("META-INF/container.xml"))
+        parser.parseBook(file.read(rootfile))
+        ops = posixpath.dirname(rootfile)
+
+        href, kind = parser.tocDocument()
+        if href:
+            toc_path = posixpath.join(ops, unquote(href))
+            toc = parser.parseToc(file.read(toc_path), kind)
+            base = posixpath.dirname(toc_path)
+        else:
+            toc = parser.spineAsToc()
+            base = ops
 
-        file = zipfile.ZipFile(self.epub, "r")
-        rootfile = ContainerParser(
-            file.read("META-INF/container.xml")
-        ).parseContainer()
-        title, author, ncx = BookParser(file.read(rootfile)).parseBook()
-        ops = "/".join(rootfile.split("/")[:-1])
-        if ops != "":
-            ops = ops + "/"
-        toc = TocParser(file.read(ops + ncx)).parseToc()
-
-        content = []
         for t in toc:
-            html = file.read(ops + t.content.split("#")[0])
-            text = html2text.html2text(html.decode("utf-8"))
+            path = t.content.split("#")[0] if t.content else ""
+            # an entry with a fragment only points into the toc document
+            # itself, which is not a chapter
+            if path and "://" not in path:
+                t.content = posixpath.normpath(posixpath.join(base, path))
+            else:
+                t.content = None
+        return toc
 
-            content.append("*" * (t.level + 1) + " " + t.text + "\n")
-            content.append(t.text + "{{{%d\n" % (t.level + 1))
-            content.append(text + "\n")
-        file.close()
-        return "".join(content)
+    def iter_chapters(self):
+        """
+        yield the converted text chapter by chapter
+        so that callers can inspect it before the whole book is built
+        """
+        with zipfile.ZipFile(self.epub, "r") as file:
+            toc = self.read_toc(file, EpubXmlParser())
 
+            for t in toc:
+                if t.content is None:
+                    continue
+                html = file.read(t.content)
+                text = html2text.html2text(html.decode("utf-8"))
+                label = t.text or ""
 
-if __name__ == "__main__":
-    if sys.argv[1]:
-        filenames = glob(sys.argv[1])
-        for filename in filenames:
+                yield (
+                    "*" * (t.level + 1)
+                    + " "
+                    + label
+                    + "\n"
+                    + label
+                    + "{{{%d\n" % (t.level + 1)
+                    + text
+                    + "\n"
+                )
+
+    def convert(self):
+        return "".join(self.iter_chapters())
+
+    def inspect(self, num_words=None, margin=2.0):
+        """
+        metadata of the epub without converting it
+        only the zip central directory, the container and the OPF are read,
+        and the number of words is estimated from the uncompressed size of
+        the spine documents.
+
+        "problems" lists what makes convert() fail.
+        "warnings" lists spine documents missing from the zip, an empty spine
+        and, with num_words, an estimate outside the range kept by
+        download_files widened by margin. they are only hints: the estimate
+        is not calibrated and convert() reads the toc, not the spine.
+        """
+        info = {
+            "title": "",
+            "author": "",
+            "language": "",
+            "spine": 0,
+            "content_bytes": 0,
+            "estimated_num_words": 0,
+            "problems": [],
+            "warnings": [],
+        }
+        problems = info["problems"]
+        warnings = info["warnings"]
+        try:
+            with zipfile.ZipFile(self.epub, "r") as file:
+                sizes = {i.filename: i.file_size for i in file.infolist()}
+                if "META-INF/container.xml" not in sizes:
+                    problems.append("no_container")
+                    return info
+                parser = EpubXmlParser()
+                rootfile = parser.parseContainer(
+                    file.read("META-INF/container.xml")
+                )
+                if rootfile not in sizes:
+                    problems.append("no_rootfile")
+                    return info
+                parser.parseBook(file.read(rootfile))
+        except zipfile.BadZipFile:
+            problems.append("bad_zip")
+            return info
+        except xml.parsers.expat.ExpatError:
+            problems.append("bad_xml")
+            return info
+
+        ops = posixpath.dirname(rootfile)
+
+        info["title"] = parser.title
+        info["author"] = parser.author
+        info["language"] = parser.language
+        info["spine"] = len(parser.spine)
+
+        href, kind = parser.tocDocument()
+        if href and posixpath.join(ops, unquote(href)) not in sizes:
+            problems.append("missing_toc")
+        if not parser.spine:
+            warnings.append("empty_spine")
+
+        content_bytes = 0
+        for idref in parser.spine:
+            href = parser.items.get(idref, "").split("#")[0]
+            path = posixpath.join(ops, unquote(href))
+            if path not in sizes:
+                if "missing_content" not in warnings:
+                    warnings.append("missing_content")
+                continue
+            content_bytes += sizes[path]
+        info["content_bytes"] = content_bytes
+        info["estimated_num_words"] = content_bytes // BYTES_PER_WORD
+
+        if num_words is not None and not (
+            num_words * 0.5 / margin
+            < info["estimated_num_words"]
+            < num_words * 1.5 * margin
+        ):
+            warnings.append("word_count")
+        return info
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha1 of a file, read in chunks"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_atomic(txt, out_path):
+    """
+    write to a temporary file in the same directory and rename it,
+    so that a killed run never leaves a truncated txt behind
+    """
+    tmp_path = "{}.{}.tmp".format(out_path, os.getpid())
+    try:
+        with open(tmp_path, "w", encoding="utf8") as f:
+            f.write(txt)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def convert_file(epub_path, out_path):
+    """
+    convert a single epub and write it atomically
+    runs in the worker processes of batch_convert
+    """
+    txt = epub2txt(epub_path).convert()
+    write_atomic(txt, out_path)
+    return epub_path, file_digest(epub_path)
+
+
+def inspect_file(epub_path):
+    info = epub2txt(epub_path).inspect()
+    info["epub"] = epub_path
+    return info
+
+
+def is_up_to_date(epub_path, out_path, skip_by, hashes):
+    if not os.path.exists(out_path):
+        return False
+    if skip_by == "mtime":
+        return os.path.getmtime(out_path) >= os.path.getmtime(epub_path)
+    if skip_by == "hash":
+        return hashes.get(os.path.basename(epub_path)) == file_digest(
+            epub_path
+        )
+    return False
+
+
+def batch_convert(
+    in_dir,
+    out_dir,
+    n_process=None,
+    skip_by="mtime",
+    error_path=None,
+    pattern="*.epub",
+):
+    """
+    convert every epub in in_dir into out_dir using a process pool
+
+    each book is written to its own txt atomically.
+    failures are appended to error_path (jsonl) instead of aborting the run.
+    already-converted books are skipped by mtime or by the sha1 of the epub
+    recorded in out_dir/.hashes.json; skip_by=None reconverts everything.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+    if n_process is None:
+        n_process = max(os.cpu_count() - 1, 1)
+    if error_path is None:
+        error_path = os.path.join(out_dir, "errors.jsonl")
+
+    hash_path = os.path.join(out_dir, ".hashes.json")
+    hashes = {}
+    if os.path.exists(hash_path):
+        with open(hash_path, "r", encoding="utf8") as f:
+            hashes = json.load(f)
+
+    jobs = []
+    n_skip = 0
+    for epub_path in sorted(glob(os.path.join(in_dir, pattern))):
+        name = os.path.basename(epub_path)
+        out_path = os.path.join(
+            out_dir, os.path.splitext(name)[0] + ".txt"
+        )
+        if is_up_to_date(epub_path, out_path, skip_by, hashes):
+            n_skip += 1
+            continue
+        jobs.append((epub_path, out_path))
+
+    sys.stderr.write(
+        "{} to convert, {} skipped as up to date.\n".format(
+            len(jobs), n_skip
+        )
+    )
+
+    n_done = 0
+    n_fail = 0
+    with ProcessPoolExecutor(max_workers=n_process) as executor, open(
+        error_path, "a", encoding="utf8"
+    ) as f_err:
+        futures = {
+            executor.submit(convert_file, epub_path, out_path): epub_path
+            for epub_path, out_path in jobs
+        }
+        for future in as_completed(futures):
+            epub_path = futures[future]
+            try:
+                _, digest = future.result()
+            except Exception as e:
+                n_fail += 1
+                record = {
+                    "epub": epub_path,
+                    "error": repr(e),
+                    "traceback": traceback.format_exc(),
+                }
+                print(json.dumps(record), file=f_err, flush=True)
+                continue
+            hashes[os.path.basename(epub_path)] = digest
+            n_done += 1
+
+    write_atomic(json.dumps(hashes), hash_path)
+    sys.stderr.write(
+        "{} converted, {} failed (see {}).\n".format(
+            n_done, n_fail, error_path
+        )
+    )
+    return n_done, n_fail
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "inputs",
+        type=str,
+        help="glob of epubs to print, or a directory with --out-dir",
+    )
+    parser.add_argument("--out-dir", "--out", type=str, default=None)
+    parser.add_argument("--n-process", "-j", type=int, default=None)
+    parser.add_argument(
+        "--skip-by", choices=["mtime", "hash"], default="mtime"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="reconvert everything, e.g. after a converter change",
+    )
+    parser.add_argument("--errors", type=str, default=None)
+    parser.add_argument(
+        "--inspect",
+        action="store_true",
+        help="print the metadata of the globbed epubs as jsonl, no conversion",
+    )
+    args = parser.parse_args()
+
+    if args.inspect:
+        with ProcessPoolExecutor(max_workers=args.n_process) as executor:
+            for info in executor.map(
+                inspect_file, sorted(glob(args.inputs)), chunksize=64
+            ):
+                print(json.dumps(info))
+        return
+
+    if args.out_dir is None:
+        for filename in glob(args.inputs):
             txt = epub2txt(filename).convert()
             print(txt)
+        return
+
+    batch_convert(
+        args.inputs,
+        args.out_dir,
+        n_process=args.n_process,
+        skip_by=None if args.force else args.skip_by,
+        error_path=args.errors,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+filter rules over the book list (ml_url_list.jsonl)
+
+the list is read once into an in-memory index keyed by the txt file name,
+and the genre/language rules are compiled into a single predicate.
+instead of moving txts between directories, the selection is written to a
+manifest (jsonl, one book per line) that make_shards reads directly,
+so switching filters does not touch the data.
+"""
+
+import json
+import os
+import re
+
+import book_archive
+
+SKIP_GENRES = ["Plays", "Screenplays"]
+
+
+def out_file_name(data):
+    """name of the txt saved by download_files for a book in the list"""
+    _, book_id = os.path.split(data["page"])
+    _, file_name = os.path.split(data["epub"])
+    return "{}__{}".format(book_id, file_name.replace(".epub", ".txt"))
+
+
+def compile_rules(languages=None, skip_genres=SKIP_GENRES):
+    """
+    build a predicate returning the reason a book is rejected, or None
+
+    languages: allowed values of "lang", None or empty for any
+    skip_genres: substrings, a book is skipped if any of its genres has one
+    """
+    languages = frozenset(languages or ())
+    if skip_genres:
+        genre_pt = re.compile("|".join(re.escape(g) for g in skip_genres))
+    else:
+        genre_pt = None
+
+    def rule(data):
+        if languages:
+            if "lang" not in data:
+                raise Exception(
+                    "Language filter is available "
+                    "when the url list has lang information. "
+                    "Please regenerate url list with the latest script."
+                )
+            if data["lang"] not in languages:
+                return "lang"
+        if genre_pt is not None and genre_pt.search(
+            "\n".join(data["genres"])
+        ):
+            return "genre"
+        return None
+
+    return rule
+
+
+def load_index(list_path):
+    """read the book list once into {txt file name: book}"""
+    index = {}
+    with open(list_path, "r", encoding="utf8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            index[out_file_name(data)] = data
+    return index
+
+
+def select_books(index, rule, txt_dir=None, archive_path=None):
+    """
+    apply a compiled rule to the index
+
+    with txt_dir, only books whose txt exists are considered;
+    the directory is listed once instead of stat-ing every book.
+    with archive_path, only books committed to that archive are, instead.
+    returns (selected, rejected) where rejected maps reason -> count
+    """
+    if archive_path is not None:
+        present = set(book_archive.BookArchive(archive_path).keys())
+    elif txt_dir is not None:
+        with os.scandir(txt_dir) as it:
+            present = set(entry.name for entry in it)
+    else:
+        present = None
+
+    selected = []
+    rejected = {}
+    for name, data in index.items():
+        if present is not None and name not in present:
+            continue
+        reason = rule(data)
+        if reason is not None:
+            rejected[reason] = rejected.get(reason, 0) + 1
+            continue
+        selected.append(
+            {
+                "file": name,
+                "title": data.get("title", ""),
+                "lang": data.get("lang", ""),
+                "genres": data["genres"],
+                "num_words": data.get("num_words"),
+            }
+        )
+    return selected, rejected
+
+
+def write_manifest(selected, manifest_path):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        for record in selected:
+            print(json.dumps(record), file=f)
+    os.replace(tmp_path, manifest_path)
+
+
+def read_manifest(manifest_path):
+    """file names listed in a selection manifest, in order"""
+    with open(manifest_path, "r", encoding="utf8") as f:
+        return [json.loads(line)["file"] for line in f if line.strip()]
@@ -6,8 +6,13 @@ Sentences that have fewer than 2 tokens or have more than 128 tokens are filtere
 Every 1,000,000 sentences form a shard.
 """
 
+import argparse
+import collections
+import json
 import os
+import signal
 import sys
+import time
 from glob import glob
 
 import re
@@ -19,51 +24,443 @@ import spacy
 
 from tqdm import tqdm
 import multiprocessing
+import multiprocessing.connection
 
+import book_archive
+import filter_rules
+from corpus_stats import CorpusStats
+from shuffle_shards import parse_size
 
-def worker(in_q, out_q, rank, tqdm_lock):
 
-    tqdm.set_lock(tqdm_lock)
+# rough resident memory of a worker with spacy loaded, until it is measured
+DEFAULT_WORKER_RSS = 1 << 30
+# a worker over worker_max_rss * HARD_RSS_FACTOR is killed mid-book
+HARD_RSS_FACTOR = 1.5
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError):
+    PAGE_SIZE = 4096
+
+
+def rss_bytes(pid):
+    """resident memory of a process, None where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def read_lines(file_path, archive=None):
+    """lines of a book, from its txt or from a packed archive"""
+    if archive is None:
+        with open(file_path, "r", encoding="utf8") as f:
+            return f.readlines()
+    return archive.read(file_path).splitlines(keepends=True)
+
+
+def process_book(file_path, nlp, archive=None, stats=None, rank=0):
+    """sentences of a book that are kept, tokenized and lowercased"""
+    book = os.path.basename(file_path)
+
+    sents, n_sent = convert_into_sentences(read_lines(file_path, archive))
+
+    processed_sents = []
+
+    for sent in tqdm(
+        sents,
+        desc=f"{book[:20]: <20}",
+        position=rank,
+        ascii=True,
+        dynamic_ncols=True,
+    ):
+        sent = sent.strip()
+        if not sent:
+            continue
+        sent = text_standardize(ftfy.fix_text(sent))
+        if len(sent) > 8192:
+            if stats is not None:
+                stats.drop(book, "too_many_chars")
+            continue
+        sent = nlp(sent)
+        if len(sent) <= 2 or len(sent) >= 128:
+            if stats is not None:
+                if len(sent) <= 2:
+                    stats.drop(book, "too_few_tokens")
+                else:
+                    stats.drop(book, "too_many_tokens")
+            continue
+        tokens = [token.text.lower() for token in sent]
+        sent = " ".join(tokens)
+
+        if purge_sent(sent):
+            if stats is not None:
+                stats.drop(book, "purged")
+            continue
+
+        if stats is not None:
+            stats.keep(book, tokens, sent)
+        processed_sents.append(sent)
+
+    return processed_sents
+
+
+def worker(
+    task_conn,
+    result_conn,
+    rank,
+    archive_path=None,
+    with_stats=False,
+    max_books=None,
+    max_rss=None,
+):
+    """
+    process the books sent by the supervisor until it sends None.
+    after max_books books, or once its resident memory is over max_rss,
+    the worker retires and the supervisor starts a fresh one.
+
+    workers can be killed at any time, by the supervisor or the OOM killer,
+    so they share no lock: a lock held by a killed worker would never be
+    released and every other worker would hang on its next progress bar.
+    the bars of the workers may interleave a little instead.
+    """
+
+    archive = None
+    if archive_path is not None:
+        archive = book_archive.BookArchive(archive_path)
 
     nlp = spacy.load(
         "en_core_web_sm", disable=["parser", "tagger", "ner", "textcat"]
     )
 
+    n_books = 0
     while True:
-        file_path = in_q.get()
+        file_path = task_conn.recv()
         if file_path is None:
             break
 
-        sents, n_sent = convert_into_sentences(
-            open(file_path, "r", encoding="utf8").readlines()
+        stats = CorpusStats() if with_stats else None
+        processed_sents = process_book(file_path, nlp, archive, stats, rank)
+        n_books += 1
+
+        rss = rss_bytes(os.getpid())
+        retiring = (max_books is not None and n_books >= max_books) or (
+            max_rss is not None and rss is not None and rss > max_rss
         )
+        result_conn.send((file_path, processed_sents, stats, retiring))
+        if retiring:
+            break
 
-        processed_sents = []
 
-        for sent in tqdm(
-            sents,
-            desc=f"{os.path.basename(file_path)[:20]: <20}",
-            position=rank,
-            ascii=True,
-            dynamic_ncols=True,
-        ):
-            sent = sent.strip()
-            if not sent:
-                continue
-            sent = text_standardize(ftfy.fix_text(sent))
-            if len(sent) > 8192:
-                continue
-            sent = nlp(sent)
-            if len(sent) <= 2 or len(sent) >= 128:
-                continue
-            sent = " ".join([token.text.lower() for token in sent])
+class WorkerHandle:
+    def __init__(self, process, task_conn, result_conn):
+        self.process = process
+        self.task_conn = task_conn
+        self.result_conn = result_conn
+        self.book = None
+        self.n_books = 0
+        # the worker exits after its current book
+        self.retiring = False
+        # the supervisor has to send it None once it is idle
+        self.stop = False
+        # it runs a single book with no memory cap and no other worker
+        self.alone = False
 
-            if purge_sent(sent):
+
+class Supervisor:
+    """
+    run the workers over the sources, yielding (source, sentences, stats)
+    as books are done
+
+    the pool starts with as many workers as fit in memory_budget and is
+    resized from the measured resident memory of the workers.
+    a worker retires after max_books books or once it grows over
+    worker_max_rss, to contain the fragmentation and leaks of long-lived
+    spacy and ftfy state, and a fresh one takes its place.
+    a worker that dies has its book queued again, up to max_retries times.
+    a worker killed for its memory, by the supervisor over
+    HARD_RSS_FACTOR * worker_max_rss or by the OOM killer, has its book
+    run again alone instead: once the books in flight are done, a fresh
+    worker without memory cap gets it and no other worker runs meanwhile.
+    the books that still fail are in failed, and are not retried.
+    """
+
+    def __init__(
+        self,
+        sources,
+        n_process=None,
+        memory_budget=None,
+        worker_max_rss=None,
+        max_books=None,
+        archive=None,
+        with_stats=False,
+        max_retries=2,
+        interval=5.0,
+    ):
+        self.pending = collections.deque(sources)
+        self.max_workers = n_process or max(multiprocessing.cpu_count() - 1, 1)
+        self.memory_budget = memory_budget
+        self.worker_max_rss = worker_max_rss
+        self.max_books = max_books
+        self.archive = archive
+        self.with_stats = with_stats
+        self.max_retries = max_retries
+        self.interval = interval
+
+        self.workers = {}
+        # tqdm positions, 0 is the main progress bar
+        self.free_ranks = list(range(self.max_workers, 0, -1))
+        self.retries = collections.Counter()
+        # books killed for their memory, to run alone
+        self.alone = collections.deque()
+        self.failed = []
+
+        self.worker_rss = worker_max_rss or DEFAULT_WORKER_RSS
+        self.target = self._fit(self.max_workers)
+        self.last_check = time.monotonic()
+
+    def _fit(self, n):
+        if self.memory_budget is None:
+            return n
+        return max(1, min(n, self.memory_budget // self.worker_rss))
+
+    def _spawn(self, alone=False):
+        rank = self.free_ranks.pop()
+        task_recv, task_send = multiprocessing.Pipe(duplex=False)
+        result_recv, result_send = multiprocessing.Pipe(duplex=False)
+        p = multiprocessing.Process(
+            target=worker,
+            args=(
+                task_recv,
+                result_send,
+                rank,
+                self.archive,
+                self.with_stats,
+                1 if alone else self.max_books,
+                None if alone else self.worker_max_rss,
+            ),
+            daemon=True,
+        )
+        p.start()
+        # keep only our ends, so that a dead worker reads as EOF
+        task_recv.close()
+        result_send.close()
+        self.workers[rank] = WorkerHandle(p, task_send, result_recv)
+        self.workers[rank].alone = alone
+        return self.workers[rank]
+
+    def _send(self, handle, task):
+        try:
+            handle.task_conn.send(task)
+        except OSError:
+            # it died, its result_conn reads as EOF and it is reaped there
+            pass
+
+    def _reap(self, rank):
+        handle = self.workers.pop(rank)
+        handle.process.join()
+        handle.task_conn.close()
+        handle.result_conn.close()
+        self.free_ranks.append(rank)
+
+        if handle.book is None:
+            return
+        book = handle.book
+        exitcode = handle.process.exitcode
+        if handle.alone:
+            self.failed.append(book)
+            sys.stderr.write(
+                f"{book} dropped, it failed alone, "
+                f"worker exit code {exitcode}\n"
+            )
+        elif exitcode == -signal.SIGKILL:
+            self.alone.append(book)
+        else:
+            self.retries[book] += 1
+            if self.retries[book] > self.max_retries:
+                self.failed.append(book)
+                sys.stderr.write(
+                    f"{book} dropped after {self.max_retries} retries, "
+                    f"worker exit code {exitcode}\n"
+                )
+            else:
+                self.pending.appendleft(book)
+
+    def _scale(self):
+        n_active = sum(1 for h in self.workers.values() if not h.retiring)
+        while n_active < self.target and self.pending and self.free_ranks:
+            self._spawn()
+            n_active += 1
+        if n_active > self.target:
+            # stop the largest workers first, after their current book
+            active = [
+                (rss_bytes(h.process.pid) or 0, rank)
+                for rank, h in self.workers.items()
+                if not h.retiring
+            ]
+            for _, rank in sorted(active, reverse=True)[
+                : n_active - self.target
+            ]:
+                self.workers[rank].retiring = True
+                self.workers[rank].stop = True
+
+    def _dispatch(self):
+        for handle in self.workers.values():
+            if handle.book is not None:
+                continue
+            if handle.stop or (not handle.retiring and not self.pending):
+                self._send(handle, None)
+                handle.retiring = True
+                handle.stop = False
+            elif not handle.retiring:
+                handle.book = self.pending.popleft()
+                self._send(handle, handle.book)
+
+    def _isolate(self):
+        """run the next book killed for its memory once every worker is idle"""
+        if any(h.book is not None for h in self.workers.values()):
+            return
+        for handle in self.workers.values():
+            if not handle.retiring or handle.stop:
+                self._send(handle, None)
+                handle.retiring = True
+                handle.stop = False
+        if not self.free_ranks:
+            # wait for the retiring workers to exit
+            return
+        handle = self._spawn(alone=True)
+        handle.book = self.alone.popleft()
+        self._send(handle, handle.book)
+
+    def _monitor(self):
+        now = time.monotonic()
+        if now - self.last_check < self.interval:
+            return
+        self.last_check = now
+
+        rss = {}
+        for rank, handle in self.workers.items():
+            if handle.alone:
                 continue
+            r = rss_bytes(handle.process.pid)
+            if r is not None:
+                rss[rank] = r
+        if not rss:
+            return
+
+        if self.worker_max_rss is not None:
+            for rank, r in rss.items():
+                if r > self.worker_max_rss * HARD_RSS_FACTOR:
+                    # its pipes are its own, so nothing shared is left
+                    # half-written; its book is requeued when it is reaped
+                    self.workers[rank].process.kill()
+
+        if self.memory_budget is None:
+            return
+        measured = [r for rank, r in rss.items() if self.workers[rank].n_books]
+        if measured:
+            self.worker_rss = max(measured)
+        n_active = sum(1 for h in self.workers.values() if not h.retiring)
+        if sum(rss.values()) > self.memory_budget:
+            self.target = max(1, min(self.target, n_active - 1))
+        else:
+            self.target = self._fit(self.max_workers)
+
+    def _shutdown(self):
+        for handle in self.workers.values():
+            if handle.book is None and not handle.retiring:
+                self._send(handle, None)
+        for handle in self.workers.values():
+            handle.process.join(timeout=self.interval)
+            if handle.process.is_alive():
+                handle.process.terminate()
+                handle.process.join()
+        self.workers = {}
+
+    def __iter__(self):
+        try:
+            while (
+                self.pending
+                or self.alone
+                or any(h.book is not None for h in self.workers.values())
+            ):
+                if self.alone:
+                    self._isolate()
+                else:
+                    self._scale()
+                    self._dispatch()
+                ready = multiprocessing.connection.wait(
+                    [h.result_conn for h in self.workers.values()],
+                    timeout=self.interval,
+                )
+                for rank, handle in list(self.workers.items()):
+                    if handle.result_conn not in ready:
+                        continue
+                    try:
+                        file_path, sents, stats, retiring = (
+                            handle.result_conn.recv()
+                        )
+                    except (EOFError, OSError):
+                        self._reap(rank)
+                        continue
+                    handle.book = None
+                    handle.n_books += 1
+                    handle.retiring = handle.retiring or retiring
+                    yield file_path, sents, stats
+                self._monitor()
+        finally:
+            self._shutdown()
+
+
+def iter_processed_sentences(
+    sources,
+    workers=None,
+    batch_size=None,
+    archive=None,
+    memory_budget=None,
+    worker_max_rss=None,
+    max_books=None,
+    stats=None,
+):
+    """
+    run the same pipeline as multiprocess_main over sources in parallel
+    and yield the kept sentences lazily, without writing shards
 
-            processed_sents.append(sent)
+    sources are txt paths, or keys of the archive at archive.
+    yields the sentences of one book at a time, in the order the books are
+    done, or lists of batch_size sentences across books with batch_size.
+    workers only start a new book once the previous results are consumed.
+    with a CorpusStats as stats, the statistics of every book are merged in.
 
-        out_q.put((file_path, processed_sents))
+        for sents in iter_processed_sentences(paths, workers=8):
+            ...
+    """
+    supervisor = Supervisor(
+        sources,
+        n_process=workers,
+        memory_budget=memory_budget,
+        worker_max_rss=worker_max_rss,
+        max_books=max_books,
+        archive=archive,
+        with_stats=stats is not None,
+    )
+    batch = []
+    for file_path, sents, book_stats in supervisor:
+        if stats is not None:
+            stats.merge(book_stats)
+        if batch_size is None:
+            yield sents
+            continue
+        batch.extend(sents)
+        start = 0
+        while len(batch) - start >= batch_size:
+            yield batch[start : start + batch_size]
+            start += batch_size
+        # trimmed once per book, not once per batch
+        del batch[:start]
+    if batch_size is not None and batch:
+        yield batch
 
 
 def convert_into_sentences(lines):
@@ -165,38 +562,76 @@ def purge_sent(sent):
     return False
 
 
-def multiprocess_main():
+def list_sources(file_dir, manifest=None, archive_path=None):
+    """
+    txts to process, either every txt in file_dir
+    or only the ones selected in a manifest written by separate_files.py
+    with an archive, the sources are its keys instead of paths
+    """
+    if archive_path is not None:
+        keys = book_archive.BookArchive(archive_path).keys()
+        if manifest is None:
+            return keys
+        keys = set(keys)
+        return [
+            name
+            for name in filter_rules.read_manifest(manifest)
+            if name in keys
+        ]
+    if manifest is None:
+        return list(sorted(glob(os.path.join(file_dir, "*.txt"))))
+    return [
+        os.path.join(file_dir, name)
+        for name in filter_rules.read_manifest(manifest)
+    ]
+
+
+def write_book_index(findex, book, shard, start, count):
+    record = {"book": book, "shard": shard, "start": start, "count": count}
+    print(json.dumps(record), file=findex)
+
+
+def multiprocess_main(
+    file_dir="out_txts",
+    out_dir="out_shards",
+    manifest=None,
+    archive=None,
+    stats_path=None,
+    vocab_path=None,
+    vocab_min_count=1,
+    n_process=None,
+    memory_budget=None,
+    worker_max_rss=None,
+    max_books=None,
+):
     """
     using multiple processes to process the txts
     with nice tqdm progress bars
     about two hours on my 16-core computer to process more than 10,000 books
+
+    with stats_path or vocab_path, the workers also collect token counts,
+    length histograms and per-book yield, merged into a json and a vocabulary
+    the size of the pool and the restarts of the workers are left to the
+    Supervisor, see there for memory_budget, worker_max_rss and max_books
     """
+    with_stats = stats_path is not None or vocab_path is not None
     multiprocessing.freeze_support()
-    n_process = multiprocessing.cpu_count() - 1
 
-    in_queue = multiprocessing.Queue()
-    out_queue = multiprocessing.Queue()
-    lock = multiprocessing.RLock()
-
-    file_dir = "out_txts"
-    file_list = list(sorted(glob(os.path.join(file_dir, "*.txt"))))
-    out_dir = "out_shards"
+    file_list = list_sources(file_dir, manifest, archive)
 
     if not os.path.exists(out_dir):
         os.makedirs(out_dir, exist_ok=True)
 
-    for file_path in file_list:
-        in_queue.put(file_path)
-    for _ in range(n_process):
-        in_queue.put(None)
-
-    processes = []
-    for i in range(n_process):
-        p = multiprocessing.Process(
-            target=worker, args=(in_queue, out_queue, i + 1, lock)
-        )
-        p.start()
-        processes.append(p)
+    supervisor = Supervisor(
+        file_list,
+        n_process=n_process,
+        memory_budget=memory_budget,
+        worker_max_rss=worker_max_rss,
+        max_books=max_books,
+        archive=archive,
+        with_stats=with_stats,
+    )
+    stats = CorpusStats() if with_stats else None
 
     shard = 0
     count = 0
@@ -207,18 +642,34 @@ def multiprocess_main():
         encoding="utf8",
     )
 
+    # where the sentences of each book are, for the book-level splits
+    # {"book", "shard", "start", "count"}, one line per book and shard
+    findex = open(
+        os.path.join(out_dir, "book_index.jsonl"), "w", encoding="utf8"
+    )
+
     with tqdm(
         total=len(file_list), ascii=True, dynamic_ncols=True, position=0
     ) as pbar:
 
-        for i in range(len(file_list)):
-            file_path, processed_sentences = out_queue.get()
+        for i, (file_path, processed_sentences, book_stats) in enumerate(
+            supervisor
+        ):
+            if stats is not None:
+                stats.merge(book_stats)
+            book = os.path.basename(file_path)
+            start = count % 1_000_000
+            n_book = 0
 
             for sent in processed_sentences:
                 print(sent, file=fout)
                 count += 1
+                n_book += 1
 
                 if count % 1_000_000 == 0:
+                    write_book_index(findex, book, shard, start, n_book)
+                    start = 0
+                    n_book = 0
                     shard += 1
                     fout.close()
                     fout = open(
@@ -227,15 +678,31 @@ def multiprocess_main():
                         encoding="utf8",
                     )
 
+            if n_book:
+                write_book_index(findex, book, shard, start, n_book)
+
             pbar.update(1)
             pbar.set_postfix_str(
                 f"shard={shard:02d}, count={count%1_000_000:06n}, i={i}, file={os.path.basename(file_path)[:20]: <20}"
             )
         fout.close()
+        findex.close()
+
+    # the books that failed, as a manifest to run them again with --manifest
+    filter_rules.write_manifest(
+        [{"file": os.path.basename(book)} for book in supervisor.failed],
+        os.path.join(out_dir, "failed_books.jsonl"),
+    )
+    if supervisor.failed:
+        sys.stderr.write(
+            f"{len(supervisor.failed)} books failed, "
+            f"see {os.path.join(out_dir, 'failed_books.jsonl')}\n"
+        )
 
-    for i, p in enumerate(processes):
-        p.join()
-        print(f"join process {i}")
+    if stats_path is not None:
+        stats.write(stats_path)
+    if vocab_path is not None:
+        stats.write_vocab(vocab_path, vocab_min_count)
 
 
 def main():
@@ -294,4 +761,69 @@ def main():
 
 
 if __name__ == "__main__":
-    multiprocess_main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file_dir", nargs="?", type=str, default="out_txts")
+    parser.add_argument("--out-dir", "--out", type=str, default="out_shards")
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="only process the books selected by separate_files.py",
+    )
+    parser.add_argument(
+        "--archive",
+        type=str,
+        default=None,
+        help="read the books from a packed archive instead of file_dir",
+    )
+    parser.add_argument(
+        "--stats",
+        type=str,
+        default=None,
+        help="write token, length and per-book statistics to this json",
+    )
+    parser.add_argument(
+        "--vocab",
+        type=str,
+        default=None,
+        help="write the frequency-ranked vocabulary to this file",
+    )
+    parser.add_argument("--vocab-min-count", type=int, default=1)
+    parser.add_argument(
+        "--n-process",
+        type=int,
+        default=None,
+        help="maximum number of workers, cpu_count() - 1 by default",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=parse_size,
+        default=None,
+        help="total resident memory of the workers, e.g. 32G",
+    )
+    parser.add_argument(
+        "--worker-max-rss",
+        type=parse_size,
+        default=None,
+        help="restart a worker once it grows over this, e.g. 2G",
+    )
+    parser.add_argument(
+        "--max-books-per-worker",
+        type=int,
+        default=None,
+        help="restart a worker after this many books",
+    )
+    args = parser.parse_args()
+    multiprocess_main(
+        args.file_dir,
+        args.out_dir,
+        args.manifest,
+        args.archive,
+        args.stats,
+        args.vocab,
+        args.vocab_min_count,
+        args.n_process,
+        args.memory_budget,
+        args.worker_max_rss,
+        args.max_books_per_worker,
+    )
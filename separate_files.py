@@ -1,66 +1,51 @@
 """
 nltk and spacy deal terribly with books that are Plays or Screenplays, mainly because of the prompts and the scene descrptions.
-This script is used to separate the downloaded txts so that the Plays and the Screenplays are excluded.
+This script is used to select the downloaded txts so that the Plays and the Screenplays are excluded.
+The txts are not moved; the selection is written to a manifest that make_shards reads with --manifest.
 """
 
-import os
+import argparse
 import sys
-import tqdm
-import json
 
+import filter_rules
 
-def main():
-    out_dir = "out_txts"
-    move_dir = "skip_txts"
-
-    if not os.path.exists(move_dir):
-        os.makedirs(move_dir, exist_ok=True)
-
-    filelist_path = "ml_url_list.jsonl"
-
-    SKIPS = ["Plays", "Screenplays"]
-
-    lines = list(open(filelist_path).readlines())
-
-    total = 0
-    done = 0
-    move = 0
-
-    progress_bar = tqdm.tqdm(lines, ascii=True)
-    for i, line in enumerate(progress_bar):
-        if not line.strip():
-            continue
-        data = json.loads(line.strip())
 
-        _, book_id = os.path.split(data["page"])
-        _, file_name = os.path.split(data["epub"])
-
-        out_file_name = f"{book_id}__{file_name.replace('.epub', '.txt')}"
-        out_path = os.path.join(out_dir, out_file_name)
-        total += 1
-        if not os.path.exists(out_path):
-            continue
-        done += 1
-
-        skip = False
-
-        for skip_genre in SKIPS:
-            for genre in data["genres"]:
-                if skip_genre in genre:
-                    skip = True
-                    break
-            if skip:
-                break
-
-        if skip:
-            os.rename(out_path, os.path.join(move_dir, out_file_name))
-            move += 1
-
-        progress_bar.set_postfix_str(
-            f"total: {total}, done: {done}, move: {move}"
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--txt-dir", type=str, default="out_txts")
+    parser.add_argument(
+        "--archive",
+        type=str,
+        default=None,
+        help="select from the books of a packed archive instead of txt_dir",
+    )
+    parser.add_argument(
+        "--list-path", "--list", type=str, default="ml_url_list.jsonl"
+    )
+    parser.add_argument(
+        "--manifest", type=str, default="selected_books.jsonl"
+    )
+    parser.add_argument(
+        "--languages", "--langs", "--lang", nargs="+", type=str, default=[]
+    )
+    parser.add_argument(
+        "--skip-genres", nargs="*", type=str, default=filter_rules.SKIP_GENRES
+    )
+    args = parser.parse_args()
+
+    index = filter_rules.load_index(args.list_path)
+    rule = filter_rules.compile_rules(args.languages, args.skip_genres)
+    selected, rejected = filter_rules.select_books(
+        index, rule, args.txt_dir, args.archive
+    )
+    filter_rules.write_manifest(selected, args.manifest)
+
+    sys.stderr.write(
+        "total: {}, selected: {}, rejected: {}\n".format(
+            len(index), len(selected), rejected
         )
+    )
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,215 @@
+"""
+This script shuffles the shards written by make_shards and splits them into train/valid/test.
+The splits are made at book level with book_index.jsonl, so that no book leaks across splits.
+The shuffle is a seeded two-pass external-memory shuffle:
+the lines are scattered into buckets on disk, then each bucket is shuffled in memory,
+so the memory is bounded by the budget and the output is reproducible from the seed.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import sys
+
+from tqdm import tqdm
+
+SPLITS = ("train", "valid", "test")
+
+# a bucket takes several times its size in memory once read as a list of lines
+MEMORY_OVERHEAD = 4
+
+
+def parse_size(size):
+    """'512M', '4G' or a number of bytes"""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def book_split(book, seed, valid_ratio, test_ratio):
+    """
+    deterministic split of a book, independent of the order of the books
+    """
+    digest = hashlib.sha1(f"{seed}:{book}".encode("utf8")).digest()
+    u = int.from_bytes(digest[:8], "big") / (1 << 64)
+    if u < test_ratio:
+        return "test"
+    if u < test_ratio + valid_ratio:
+        return "valid"
+    return "train"
+
+
+def read_book_index(shard_dir):
+    """shard -> [(start, count, book)] sorted by start"""
+    segments = {}
+    with open(
+        os.path.join(shard_dir, "book_index.jsonl"), "r", encoding="utf8"
+    ) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            segments.setdefault(record["shard"], []).append(
+                (record["start"], record["count"], record["book"])
+            )
+    for shard in segments:
+        segments[shard].sort()
+    return segments
+
+
+def scatter(
+    shard_paths, segments, splits_of, bucket_dir, n_bucket, seed, buffering
+):
+    """first pass: append every line to a random bucket of its split"""
+    rng = random.Random(seed)
+    buckets = {
+        split: [
+            open(
+                os.path.join(bucket_dir, f"{split}_{k:04d}.txt"),
+                "wb",
+                buffering=buffering,
+            )
+            for k in range(n_bucket)
+        ]
+        for split in SPLITS
+    }
+    n_lines = {split: 0 for split in SPLITS}
+
+    for shard, shard_path in enumerate(tqdm(shard_paths, ascii=True)):
+        shard_segments = iter(segments.get(shard, []))
+        end = 0
+        split = None
+        with open(shard_path, "rb") as f:
+            for i, line in enumerate(f):
+                while i >= end:
+                    try:
+                        start, count, book = next(shard_segments)
+                    except StopIteration:
+                        raise Exception(
+                            f"line {i} of {shard_path} "
+                            "is not in book_index.jsonl"
+                        )
+                    end = start + count
+                    split = splits_of[book]
+                buckets[split][rng.randrange(n_bucket)].write(line)
+                n_lines[split] += 1
+
+    for split_buckets in buckets.values():
+        for fbucket in split_buckets:
+            fbucket.close()
+    return n_lines
+
+
+def gather(bucket_dir, out_dir, n_bucket, seed):
+    """second pass: shuffle each bucket in memory and concatenate them"""
+    for split in SPLITS:
+        with open(os.path.join(out_dir, f"{split}.txt"), "wb") as fout:
+            for k in tqdm(range(n_bucket), desc=split, ascii=True):
+                bucket_path = os.path.join(
+                    bucket_dir, f"{split}_{k:04d}.txt"
+                )
+                with open(bucket_path, "rb") as f:
+                    lines = f.readlines()
+                random.Random(f"{seed}:{split}:{k}").shuffle(lines)
+                fout.writelines(lines)
+                os.remove(bucket_path)
+
+
+def shuffle_shards(
+    shard_dir,
+    out_dir,
+    seed=0,
+    valid_ratio=0.01,
+    test_ratio=0.01,
+    memory_budget=1 << 30,
+):
+    segments = read_book_index(shard_dir)
+    shard_paths = [
+        os.path.join(shard_dir, f"book_corpus_{shard:02d}.txt")
+        for shard in range(max(segments, default=-1) + 1)
+    ]
+
+    books = sorted(set(book for s in segments.values() for _, _, book in s))
+    splits_of = {
+        book: book_split(book, seed, valid_ratio, test_ratio) for book in books
+    }
+
+    total_bytes = sum(os.path.getsize(path) for path in shard_paths)
+    n_bucket = max(
+        1, math.ceil(total_bytes * MEMORY_OVERHEAD / memory_budget)
+    )
+    # the write buffers of all the buckets stay within the budget too
+    buffering = min(
+        max(memory_budget // (2 * len(SPLITS) * n_bucket), 1 << 13), 1 << 20
+    )
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+    bucket_dir = os.path.join(out_dir, "buckets")
+    os.makedirs(bucket_dir, exist_ok=True)
+
+    sys.stderr.write(
+        f"{len(books)} books, {total_bytes} bytes, {n_bucket} buckets\n"
+    )
+    n_lines = scatter(
+        shard_paths,
+        segments,
+        splits_of,
+        bucket_dir,
+        n_bucket,
+        seed,
+        buffering,
+    )
+    gather(bucket_dir, out_dir, n_bucket, seed)
+    shutil.rmtree(bucket_dir)
+
+    splits_path = os.path.join(out_dir, "splits.json")
+    with open(splits_path, "w", encoding="utf8") as f:
+        json.dump(
+            {
+                "seed": seed,
+                "valid_ratio": valid_ratio,
+                "test_ratio": test_ratio,
+                "lines": n_lines,
+                "books": {
+                    split: [b for b in books if splits_of[b] == split]
+                    for split in SPLITS
+                },
+            },
+            f,
+        )
+    return n_lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "shard_dir", nargs="?", type=str, default="out_shards"
+    )
+    parser.add_argument("--out-dir", "--out", type=str, default="out_splits")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--valid", type=float, default=0.01)
+    parser.add_argument("--test", type=float, default=0.01)
+    parser.add_argument(
+        "--memory-budget",
+        type=str,
+        default="1G",
+        help="memory for one bucket in the second pass, e.g. 512M or 4G",
+    )
+    args = parser.parse_args()
+
+    n_lines = shuffle_shards(
+        args.shard_dir,
+        args.out_dir,
+        args.seed,
+        args.valid,
+        args.test,
+        parse_size(args.memory_budget),
+    )
+    sys.stderr.write(f"{n_lines}\n")